@@ -32,3 +32,7 @@ name = 'meteoserver'
 from .weatherforecast import *
 from .sundata import *
 from .help import *
+from .singleflight import *
+from .quota import *
+from .blend import *
+from .store import *
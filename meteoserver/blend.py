@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#  Copyright (c) 2020-2021  Marc van der Sluys - marc.vandersluys.nl
+#
+#  This file is part of the Meteoserver Python package, containing a Python module to obtain and read Dutch
+#  weather data from Meteoserver.nl.  See: https://github.com/MarcvdSluys/Meteoserver
+#
+#  This is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+#  This software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with this code.  If not, see
+#  <http://www.gnu.org/licenses/>.
+
+
+"""
+   Functions to blend HARMONIE (48 hours, high resolution) and GFS (10 days) weather forecasts from
+   Meteoserver.nl into a single, seamless forecast.
+"""
+
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from .singleflight import read_json_url_weatherforecast_shared
+from .quota import PRIORITY_NORMAL
+
+
+# Columns that contain codes or text rather than quantities; these are taken from the dominant model:
+_categoricalColumns = ['windrltr', 'cond', 'ico', 'samenv', 'icoon']
+
+# Integer codes, which become float after merging the two models:
+_integerColumns = ['cond', 'ico']
+
+# Columns that describe the model run rather than the weather, and are not blended:
+_modelColumns = ['offset']
+
+
+def read_json_url_blendedforecast(key, locations, weights=(24, 48), workers=8, quota=None,
+                                  priority=PRIORITY_NORMAL):
+    """Get HARMONIE and GFS weather-forecast data for a batch of locations from the Meteoserver server and
+    blend them into a single forecast dataframe.
+
+    The two models are downloaded concurrently for all locations, using read_json_url_weatherforecast_shared().
+    The result contains hourly data for the HARMONIE horizon (48 hours), smoothly blended into the GFS
+    forecast, followed by the hourly and three-hourly GFS data up to 10 days.  See blend_forecasts() for details.
+
+    Parameters:
+        key (string):           The Meteoserver API key.
+        locations (list):       List of names of the locations (in the Netherlands) to obtain data for (e.g.
+                                ['De Bilt', 'Arnhem']).  A single location name can be given as a string;
+                                duplicates are removed.
+        weights (tuple/function):  The weight of the HARMONIE model as a function of lead time.  See
+                                harmonie_weights() (default: (24, 48)).
+        workers (int):          Maximum number of concurrent downloads (default: 8).
+        quota (QuotaManager):   Take the requests from this API quota, if given (default: None).
+        priority (int):         The priority of the requests for the quota (default: PRIORITY_NORMAL).
+
+    Returns:
+        (df):  Pandas dataframe containing the blended forecast data for all locations, with the requested location
+        name in the column 'location' and the weight of the HARMONIE model in the column 'weight'.
+    """
+
+    if(isinstance(locations, str)):
+        locations = [locations]
+    locations = list(dict.fromkeys(locations))  # Remove duplicates, keep order
+
+    # Download both models for all locations concurrently:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for model in ['HARMONIE', 'GFS']:
+            for location in locations:
+                futures[(model, location)] = executor.submit(read_json_url_weatherforecast_shared, key, location,
+                                                             model=model, quota=quota, priority=priority)
+
+        harmonie = _concat_locations(locations, [futures[('HARMONIE', location)].result() for location in locations])
+        gfs      = _concat_locations(locations, [futures[('GFS',      location)].result() for location in locations])
+
+    return blend_forecasts(harmonie, gfs, weights=weights)
+
+
+def blend_forecasts(harmonie, gfs, weights=(24, 48)):
+    """Blend HARMONIE and GFS weather-forecast dataframes for one or more locations into a single forecast.
+
+    The two forecasts are aligned on their 'tijd' column (and 'location' column, if present).  Where both models
+    have data, each quantity is the weighted mean of the two models, with the HARMONIE weight depending on the lead
+    time (the number of hours since the HARMONIE model run, from its 'offset' column).  For a (start, end) ramp,
+    the end is moved back to the last HARMONIE forecast time for each location if HARMONIE ends earlier, so
+    that the HARMONIE weight always reaches zero before its data run out.  Where only one model has data, that
+    model is used.  Wind directions are averaged as vectors, and codes and descriptions ('cond', 'ico',
+    'samenv', etc.) are taken from the model with the larger weight.  The model-run column 'offset' is dropped.
+
+    All operations are vectorised over the whole batch of locations.  The dataframes must have been read with
+    numeric=True.
+
+    Parameters:
+        harmonie (df):  Pandas dataframe containing HARMONIE forecast data.
+        gfs (df):       Pandas dataframe containing GFS forecast data.
+        weights (tuple/function):  The weight of the HARMONIE model as a function of lead time.  See
+                        harmonie_weights() (default: (24, 48)).
+
+    Returns:
+        (df):  Pandas dataframe containing the blended forecast data, sorted by location and time, with the
+        weight of the HARMONIE model in the column 'weight'.
+    """
+
+    keys = ['location', 'tijd'] if('location' in harmonie.columns and 'location' in gfs.columns) else ['tijd']
+
+    # The HARMONIE model-run time (the first forecast time if unknown) and last forecast time for each location:
+    if('offset' in harmonie.columns):
+        runTimes = harmonie['tijd'] - harmonie['offset'].fillna(0) * 3600
+    else:
+        runTimes = harmonie['tijd']
+
+    harmonie = harmonie.drop(columns=[col for col in _modelColumns if col in harmonie.columns])
+    gfs      = gfs.drop(columns=[col for col in _modelColumns if col in gfs.columns])
+
+    # Align the two models on time (and location), keeping the times of both:
+    data = pd.merge(harmonie, gfs, on=keys, how='outer', suffixes=('_h', '_g'), indicator=True)
+    data.sort_values(keys, inplace=True, ignore_index=True)
+
+    # Compute the lead time and HARMONIE weight for each row:
+    if(len(keys) > 1):
+        runTime  = data['location'].map(runTimes.groupby(harmonie['location']).min())
+        lastTime = data['location'].map(harmonie['tijd'].groupby(harmonie['location']).max())
+    else:
+        runTime  = runTimes.min()
+        lastTime = harmonie['tijd'].max()
+    leadHours = np.asarray((data['tijd'] - runTime) / 3600, dtype=float)
+    lastHours = np.asarray((lastTime - runTime) / 3600, dtype=float)
+
+    weight = harmonie_weights(leadHours, weights, lastHours=lastHours)
+    weight = np.where(data['_merge'] == 'left_only',  1.0, weight)  # Only HARMONIE data
+    weight = np.where(data['_merge'] == 'right_only', 0.0, weight)  # Only GFS data
+
+    blended = data[keys].copy()
+    columns = [col for col in harmonie.columns if col not in keys]
+    columns = columns + [col for col in gfs.columns if col not in keys and col not in columns]
+
+    for col in columns:
+        if(col not in gfs.columns):       # HARMONIE only
+            blended[col] = data[col]
+        elif(col not in harmonie.columns):  # GFS only
+            blended[col] = data[col]
+        else:
+            blended[col] = _blend_column(col, data[col+'_h'], data[col+'_g'], weight)
+
+        if(col in _integerColumns and pd.api.types.is_numeric_dtype(blended[col])):
+            blended[col] = blended[col].round().astype('Int64')  # Integer codes, with missing values
+
+    blended['weight'] = weight
+
+    return blended
+
+
+def harmonie_weights(leadHours, weights=(24, 48), lastHours=None):
+    """Compute the weight of the HARMONIE model in the blend as a function of lead time.
+
+    Parameters:
+        leadHours (array):  Array containing lead times in hours.
+        weights (tuple/function):  Either a tuple (start, end), such that the HARMONIE weight is 1 up to a lead time
+                            of start hours and decreases linearly to 0 at end hours (default: (24, 48)), or a
+                            function that takes the array of lead times and returns an array of HARMONIE weights
+                            between 0 and 1.
+        lastHours (float/array):  The lead time of the last HARMONIE forecast, per row (default: None).  If given and
+                            earlier than the end of a (start, end) ramp, the ramp ends there (and starts no later),
+                            so that the weight reaches zero at the last HARMONIE forecast.  Not used for functions.
+
+    Returns:
+        (array):  Array containing the HARMONIE weights, between 0 and 1.  The GFS weight is 1 minus this value.
+    """
+
+    leadHours = np.asarray(leadHours, dtype=float)
+
+    if(callable(weights)):
+        weight = np.asarray(weights(leadHours), dtype=float)
+    else:
+        start, end = weights
+        end   = np.full(leadHours.shape, end, dtype=float)
+        if(lastHours is not None):
+            end = np.fmin(end, lastHours)  # fmin: ignore unknown (NaN) last times
+        start = np.minimum(start, end)
+
+        width = end - start
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(width > 0, (end - leadHours) / np.where(width > 0, width, 1),
+                              np.where(leadHours < end, 1.0, 0.0))
+
+    return np.clip(weight, 0, 1)
+
+
+def _blend_column(col, harmonie, gfs, weight):
+    """Blend a single column of the two models, using the HARMONIE weight.
+
+    Parameters:
+        col (string):     The name of the column.
+        harmonie (Series):  The HARMONIE values.
+        gfs (Series):     The GFS values.
+        weight (array):   The HARMONIE weights.
+
+    Returns:
+        (array/Series):  The blended values.
+    """
+
+    if(col in _categoricalColumns or not (pd.api.types.is_numeric_dtype(harmonie)
+                                          and pd.api.types.is_numeric_dtype(gfs))):
+        # Take codes, text and times from the dominant model, or from the other if it is missing:
+        return harmonie.where(weight >= 0.5, gfs).fillna(gfs).fillna(harmonie)
+
+    valH = harmonie.to_numpy(dtype=float)
+    valG = gfs.to_numpy(dtype=float)
+
+    # Use only the model that has data where the other one is missing:
+    weight = np.where(np.isnan(valG), 1.0, np.where(np.isnan(valH), 0.0, weight))
+    valH   = np.where(np.isnan(valH), 0.0, valH)
+    valG   = np.where(np.isnan(valG), 0.0, valG)
+
+    if(col == 'windr'):  # Wind direction in degrees: average the unit vectors
+        dirH = np.radians(valH)
+        dirG = np.radians(valG)
+        blended = np.degrees(np.arctan2(weight*np.sin(dirH) + (1-weight)*np.sin(dirG),
+                                        weight*np.cos(dirH) + (1-weight)*np.cos(dirG))) % 360
+    else:
+        blended = weight*valH + (1-weight)*valG
+
+    return np.where(np.isnan(harmonie.to_numpy(dtype=float)) & np.isnan(gfs.to_numpy(dtype=float)), np.nan, blended)
+
+
+def _concat_locations(locations, dataFrames):
+    """Concatenate the forecast dataframes for a batch of locations, adding a 'location' column.
+
+    Parameters:
+        locations (list):   List of location names.
+        dataFrames (list):  List of Pandas dataframes, one for each location.
+
+    Returns:
+        (df):  Pandas dataframe containing the data for all locations.
+    """
+
+    dataFrames = [data.assign(location=location) for location, data in zip(locations, dataFrames)]
+    data = pd.concat(dataFrames, ignore_index=True)
+
+    return data[['location'] + [col for col in data.columns if col != 'location']]  # Location first
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+#  Copyright (c) 2020-2021  Marc van der Sluys - marc.vandersluys.nl
+#
+#  This file is part of the Meteoserver Python package, containing a Python module to obtain and read Dutch
+#  weather data from Meteoserver.nl.  See: https://github.com/MarcvdSluys/Meteoserver
+#
+#  This is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+#  This software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with this code.  If not, see
+#  <http://www.gnu.org/licenses/>.
+
+
+"""
+   Command-line interface to download weather-forecast and Sun data for a list of locations from Meteoserver.nl
+   and export them to CSV, JSON or Parquet files.
+"""
+
+
+import argparse
+import datetime
+import json
+import math
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .weatherforecast import write_json_file_weatherforecast
+from .sundata import write_json_file_sunData
+from .singleflight import read_json_url_weatherforecast_shared, read_json_url_sunData_shared
+from .quota import QuotaManager, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+
+# Times (hour, minute; CE(S)T) at which new model runs are published:
+_runTimes = {'HARMONIE': [(5,30), (11,30), (17,30), (23,30)],
+             'GFS':      [(0,30), (7,30), (12,30), (18,30)]}
+
+_extensions = {'csv': 'csv', 'json': 'json', 'parquet': 'parquet'}
+
+_priorities = {'high': PRIORITY_HIGH, 'normal': PRIORITY_NORMAL, 'low': PRIORITY_LOW}
+
+# File in the output directory recording the exported model run per model and location:
+_stateFileName = '.meteoserver_runs.json'
+
+
+def main(argv=None):
+    """Run the meteoserver command-line program.
+
+    Downloads the data for all locations and models concurrently, writes the output files in parallel, and
+    prints timing statistics.  Output files are named after the model run found in the downloaded data.  Each
+    location and model is exported once for each publication time of the model: the exported run is recorded in
+    the file .meteoserver_runs.json in the output directory, so that a resumed or repeated run skips it until the
+    next model run is due.  If the server still returns the previous run, the export is not recorded and will be
+    retried.  Run 'meteoserver --help' for the options.
+
+    Parameters:
+        argv (list):  List of command-line arguments (default: None - use sys.argv).
+
+    Returns:
+        int:  Exit code: 0 on success, 1 if one or more downloads or exports failed, 130 if interrupted.
+    """
+
+    args = _parse_arguments(argv)
+
+    if(args.key is None):
+        print('meteoserver: error: no API key given; use --key or set METEOSERVER_KEY', file=sys.stderr)
+        return 1
+
+    locations = list(args.locations)
+    if(args.locations_file is not None):
+        locations += _read_locations_file(args.locations_file)
+    if(len(locations) == 0):
+        print('meteoserver: error: no locations given', file=sys.stderr)
+        return 1
+
+    if(args.format == 'parquet'):
+        try:
+            import pyarrow  # noqa: F401 - needed by pandas.DataFrame.to_parquet()
+        except ImportError:
+            print('meteoserver: error: the Parquet format requires the pyarrow package', file=sys.stderr)
+            return 1
+
+    quota = None
+    if(args.quota_db is not None):
+        quota = QuotaManager(args.quota_db, dailyQuota=args.daily_quota, rate=args.rate, burst=args.burst)
+    priority = _priorities[args.priority]
+
+    os.makedirs(args.outdir, exist_ok=True)
+    stateFile = os.path.join(args.outdir, _stateFileName)
+    state     = _read_state(stateFile)
+
+    # Create the list of tasks, skipping the ones that were exported for the current publication time:
+    tasks   = []
+    skipped = 0
+    now = _now_nl()
+    for model in args.model:
+        slot = _publication_slot(model, now)
+        for location in dict.fromkeys(locations):  # Remove duplicates, keep order
+            done = state.get(_state_key(model, location))
+            if(not args.force and done is not None and done['slot'] >= slot
+               and all(os.path.exists(fileName) for fileName in
+                       _output_file_names(args.outdir, location, model, done['run'], args.format))):
+                skipped += 1
+            else:
+                tasks.append((location, model, slot))
+
+    progress = _Progress(len(tasks) + skipped, skipped, enabled=not args.quiet)
+    failures = []
+    stale    = []
+    fetchTimes = []
+    writeTimes = []
+    startTime  = time.perf_counter()
+
+    numeric   = args.format != 'json'  # Keep JSON output (nearly) identical to the original format
+    cancel    = threading.Event()          # Set on Ctrl-C, to stop downloads waiting for the quota
+    fetchPool = ThreadPoolExecutor(max_workers=args.jobs)
+    writePool = ThreadPoolExecutor(max_workers=args.write_jobs)
+    interrupted = False
+    try:
+        pending = {fetchPool.submit(_timed, _fetch, args.key, location, model, args.full, numeric, quota, priority,
+                                    cancel): ('download', location, model, slot, None, None)
+                   for location, model, slot in tasks}
+
+        while(len(pending) > 0):
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, location, model, slot, run, current = pending.pop(future)
+                try:
+                    result, duration = future.result()
+                except (Exception, SystemExit) as e:  # Also catch exit() by read_json_url_weatherforecast()
+                    failures.append((location, model, stage, e))
+                    progress.update(failed=1)
+                    continue
+
+                if(stage == 'download'):
+                    fetchTimes.append(duration)
+                    progress.update(fetched=1)
+
+                    # Is this a new model run?  If a new run is due but the server still returns the exported
+                    # one, it has not been published yet.  Otherwise, the same run is exported again on request
+                    # (--force or a different format):
+                    run  = _data_run(result)
+                    done = state.get(_state_key(model, location))
+                    due  = done is None or done['slot'] < slot
+                    current = run is None or done is None or run > done['run']
+                    if(run is None):  # Sun data: no model run, use the publication time
+                        run = slot
+
+                    fileNames = _output_file_names(args.outdir, location, model, run, args.format)
+                    if(due and not current and not args.force
+                       and all(os.path.exists(fileName) for fileName in fileNames)):
+                        stale.append((location, model, run))
+                        progress.update(stale=1)
+                        continue
+
+                    pending[writePool.submit(_timed, _write, result, fileNames, args.format)] = \
+                        ('export', location, model, slot, run, current)
+
+                else:
+                    writeTimes.append(duration)
+                    progress.update(written=1)
+                    if(current):  # Not recorded otherwise, so that a due new run is downloaded again
+                        state[_state_key(model, location)] = {'slot': slot, 'run': run}
+                        _write_state(stateFile, state)
+
+    except KeyboardInterrupt:
+        # Do not start the queued downloads and exports, and stop the ones waiting for the quota.  Do not wait
+        # for the threads here; only a download or export that is already running will be finished:
+        interrupted = True
+        cancel.set()
+        fetchPool.shutdown(wait=False, cancel_futures=True)
+        writePool.shutdown(wait=False, cancel_futures=True)
+        progress.finish()
+        print('meteoserver: interrupted; rerun the same command to resume', file=sys.stderr)
+        return 130
+
+    finally:
+        if(not interrupted):
+            fetchPool.shutdown()
+            writePool.shutdown()
+
+    progress.finish()
+    totalTime = time.perf_counter() - startTime
+
+    for location, model, stage, error in failures:
+        print('meteoserver: error: '+stage+' failed for '+location+' ('+model+'): '+str(error), file=sys.stderr)
+    for location, model, run in stale:
+        print('meteoserver: warning: the server still returned model run '+run+' for '+location+' ('+model
+              +'); rerun later to get the new run', file=sys.stderr)
+
+    if(not args.quiet):
+        _print_statistics(len(tasks), skipped, len(stale), len(failures), fetchTimes, writeTimes, totalTime)
+
+    return 1 if(len(failures) > 0) else 0
+
+
+def _parse_arguments(argv):
+    """Parse the command-line arguments."""
+
+    parser = argparse.ArgumentParser(prog='meteoserver',
+                                     description='Download weather-forecast and Sun data for a list of locations '
+                                     'from Meteoserver.nl and export them to CSV, JSON or Parquet files.')
+
+    parser.add_argument('locations', nargs='*', metavar='LOCATION',
+                        help='name of a location (in the Netherlands), e.g. "De Bilt"')
+    parser.add_argument('-l', '--locations-file', metavar='FILE',
+                        help='file containing one location per line (lines starting with # are ignored)')
+    parser.add_argument('-k', '--key', default=os.environ.get('METEOSERVER_KEY'),
+                        help='Meteoserver API key (default: $METEOSERVER_KEY)')
+    parser.add_argument('-m', '--model', action='append', choices=['HARMONIE', 'GFS', 'sun'],
+                        help='data to download; can be given more than once (default: GFS)')
+    parser.add_argument('-f', '--format', choices=sorted(_extensions), default='csv',
+                        help='output format (default: csv)')
+    parser.add_argument('-o', '--outdir', default='.', help='output directory (default: .)')
+    parser.add_argument('--full', action='store_true', help='export all weather-forecast columns')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='number of concurrent downloads (default: 8)')
+    parser.add_argument('--write-jobs', type=int, default=4, help='number of parallel exports (default: 4)')
+    parser.add_argument('--force', action='store_true',
+                        help='download and export again, even if the current model run was already exported')
+    parser.add_argument('--quota-db', metavar='FILE',
+                        help='share the API quota with other processes through this SQLite file')
+    parser.add_argument('--daily-quota', type=int, default=500,
+                        help='daily API quota, used with --quota-db (default: 500)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='requests per second added to the quota token bucket, used with --quota-db (default: '
+                        'the daily quota spread evenly over 24 hours, i.e. one request every 173 s for a quota of '
+                        '500 - a batch larger than --burst is then slow; a higher rate finishes batches sooner, but '
+                        'uses more of the daily quota early in the day)')
+    parser.add_argument('--burst', type=int, default=10,
+                        help='number of requests that can be made at once (token-bucket size), used with '
+                        '--quota-db (default: 10)')
+    parser.add_argument('--priority', choices=list(_priorities), default='normal',
+                        help='priority of the requests for the shared quota, used with --quota-db (default: normal)')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not show progress and timing statistics')
+
+    args = parser.parse_args(argv)
+    if(args.model is None):
+        args.model = ['GFS']
+    args.model = list(dict.fromkeys(args.model))  # Remove duplicates, keep order
+
+    return args
+
+
+def _read_locations_file(fileName):
+    """Read a list of locations from a text file, one per line, skipping empty lines and comments."""
+
+    with open(fileName) as inFile:
+        lines = [line.strip() for line in inFile]
+
+    return [line for line in lines if(line != '' and not line.startswith('#'))]
+
+
+def _timezone_nl():
+    """Return the time zone of the Netherlands, or None (local time) if it is unknown."""
+
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo('Europe/Amsterdam')
+    except Exception:  # No zoneinfo module or time-zone database
+        return None
+
+
+def _now_nl():
+    """Return the current date and time in the Netherlands (or the local time if the time zone is unknown)."""
+    return datetime.datetime.now(_timezone_nl()).replace(tzinfo=None)
+
+
+def _publication_slot(model, now):
+    """Return a label for the latest publication time of a model, at which a new model run should be available.
+
+    This is only used to decide whether a new download is due; the output files are named after the model run
+    found in the data.  The Sun data are updated more frequently, and are labelled with the current hour.
+
+    Parameters:
+        model (string):  'HARMONIE', 'GFS' or 'sun'.
+        now (datetime):  The current date and time in the Netherlands.
+
+    Returns:
+        string:  Label of the form YYYYMMDDTHHMM.
+    """
+
+    if(model not in _runTimes):
+        return now.strftime('%Y%m%dT%H00')
+
+    published = [now.replace(hour=hour, minute=minute, second=0, microsecond=0) for hour, minute in _runTimes[model]]
+    published = [pubTime for pubTime in published if(pubTime <= now)]
+    if(len(published) == 0):  # The last publication of yesterday
+        hour, minute = _runTimes[model][-1]
+        published = [(now - datetime.timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)]
+
+    return max(published).strftime('%Y%m%dT%H%M')
+
+
+def _data_run(result):
+    """Return a label for the model run of downloaded weather-forecast data, or None if it is unknown.
+
+    The run time is the time of the first forecast minus its 'offset', the number of hours since the model run.
+
+    Parameters:
+        result (tuple):  Tuple (model, location name, dataframes) as returned by _fetch().
+
+    Returns:
+        string:  Label of the form YYYYMMDDTHHMM (time in the Netherlands), or None.
+    """
+
+    model, retLoc, dataFrames = result
+    data = dataFrames[0]
+    if(model == 'sun' or len(data) == 0 or 'tijd' not in data.columns or 'offset' not in data.columns):
+        return None
+
+    try:  # The data may be numeric or strings
+        runTime = float(data['tijd'].iloc[0]) - float(data['offset'].iloc[0]) * 3600
+    except (TypeError, ValueError):
+        return None
+    if(math.isnan(runTime)):
+        return None
+
+    timeZone = _timezone_nl()
+    return datetime.datetime.fromtimestamp(runTime, timeZone).strftime('%Y%m%dT%H%M')
+
+
+def _state_key(model, location):
+    """Return the key for a model and location in the state file."""
+    return model + '|' + location
+
+
+def _read_state(stateFile):
+    """Read the exported model runs from the state file: {model|location: {'slot': label, 'run': label}}."""
+
+    try:
+        with open(stateFile) as inFile:
+            return json.load(inFile)
+    except (OSError, ValueError):  # No (valid) state file: export everything
+        return {}
+
+
+def _write_state(stateFile, state):
+    """Write the exported model runs to the state file, atomically."""
+
+    with open(stateFile + '.part', 'w') as outFile:
+        json.dump(state, outFile, indent=1, sort_keys=True)
+    os.replace(stateFile + '.part', stateFile)
+
+
+def _output_file_names(outDir, location, model, run, fileFormat):
+    """Return the list of output files for a location, model and run.
+
+    CSV and Parquet exports of Sun data consist of two files, for the current and forecast data.
+    """
+
+    baseName = os.path.join(outDir, re.sub(r'[^\w.-]+', '_', location).strip('_') + '_' + model + '_' + run)
+    extension = '.' + _extensions[fileFormat]
+
+    if(model == 'sun' and fileFormat != 'json'):
+        return [baseName + '_current' + extension, baseName + '_forecast' + extension]
+    else:
+        return [baseName + extension]
+
+
+def _fetch(key, location, model, full, numeric, quota, priority, cancel):
+    """Download the data for a location and model, and return a tuple (model, location name, dataframes)."""
+
+    if(model == 'sun'):
+        current, forecast, retLoc = read_json_url_sunData_shared(key, location, loc=True, numeric=numeric,
+                                                                 quota=quota, priority=priority, cancel=cancel)
+        return model, retLoc, [current, forecast]
+    else:
+        data, retLoc = read_json_url_weatherforecast_shared(key, location, model=model, full=full, loc=True,
+                                                            numeric=numeric, quota=quota, priority=priority,
+                                                            cancel=cancel)
+        return model, retLoc, [data]
+
+
+def _write(result, fileNames, fileFormat):
+    """Write the downloaded data to file(s).
+
+    Each file is written under a temporary name and then renamed, so that an interrupted run never leaves an
+    incomplete output file.  The temporary files are removed if the export fails.
+    """
+
+    model, retLoc, dataFrames = result
+    tmpNames = [fileName + '.part' for fileName in fileNames]
+
+    try:
+        if(fileFormat == 'json'):
+            if(model == 'sun'):
+                write_json_file_sunData(tmpNames[0], retLoc, dataFrames[0], dataFrames[1])
+            else:
+                write_json_file_weatherforecast(tmpNames[0], retLoc, dataFrames[0])
+        else:
+            for data, tmpName in zip(dataFrames, tmpNames):
+                if(fileFormat == 'csv'):
+                    data.to_csv(tmpName, index=False)
+                else:
+                    data.to_parquet(tmpName, index=False)
+
+        for tmpName, fileName in zip(tmpNames, fileNames):
+            os.replace(tmpName, fileName)
+
+    except BaseException:
+        for tmpName in tmpNames:
+            if(os.path.exists(tmpName)):
+                os.remove(tmpName)
+        raise
+
+
+def _timed(function, *args):
+    """Call a function and return a tuple containing its return value and its wall-clock duration in seconds."""
+
+    startTime = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - startTime
+
+
+class _Progress:
+    """Show a single-line progress display on stderr, if it is a terminal."""
+
+    def __init__(self, total, skipped, enabled=True):
+        self.total   = total
+        self.counts  = {'fetched': 0, 'written': 0, 'stale': 0, 'failed': 0, 'skipped': skipped}
+        self.enabled = enabled and sys.stderr.isatty()
+        self.lock    = threading.Lock()
+        self._show()
+
+    def update(self, **increments):
+        with self.lock:
+            for name, increment in increments.items():
+                self.counts[name] += increment
+            self._show()
+
+    def finish(self):
+        if(self.enabled):
+            print(file=sys.stderr)
+
+    def _show(self):
+        if(self.enabled):
+            done = self.counts['written'] + self.counts['stale'] + self.counts['failed'] + self.counts['skipped']
+            print('\r%i/%i done: %i downloaded, %i written, %i skipped, %i stale, %i failed'
+                  % (done, self.total, self.counts['fetched'], self.counts['written'], self.counts['skipped'],
+                     self.counts['stale'], self.counts['failed']), end='', file=sys.stderr, flush=True)
+
+
+def _print_statistics(nTasks, skipped, stale, failed, fetchTimes, writeTimes, totalTime):
+    """Print timing statistics for the downloads and exports."""
+
+    print('%i tasks, %i skipped (already exported for the current model run), %i stale (new run not yet published), '
+          '%i failed' % (nTasks, skipped, stale, failed), file=sys.stderr)
+
+    for name, durations in [('download', fetchTimes), ('export', writeTimes)]:
+        if(len(durations) > 0):
+            print('%-8s  n: %4i   mean: %7.3f s   median: %7.3f s   max: %7.3f s   sum: %8.3f s'
+                  % (name, len(durations), statistics.mean(durations), statistics.median(durations),
+                     max(durations), sum(durations)), file=sys.stderr)
+
+    print('total wall-clock time: %.3f s' % totalTime, end='', file=sys.stderr)
+    if(totalTime > 0 and len(writeTimes) > 0):
+        print(' (%.1f exports/s)' % (len(writeTimes)/totalTime), end='', file=sys.stderr)
+    print(file=sys.stderr)
+
+
+if(__name__ == '__main__'):
+    sys.exit(main())
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+#  Copyright (c) 2020-2021  Marc van der Sluys - marc.vandersluys.nl
+#
+#  This file is part of the Meteoserver Python package, containing a Python module to obtain and read Dutch
+#  weather data from Meteoserver.nl.  See: https://github.com/MarcvdSluys/Meteoserver
+#
+#  This is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+#  This software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with this code.  If not, see
+#  <http://www.gnu.org/licenses/>.
+
+
+"""
+   Keep track of the daily Meteoserver API request quota, shared between threads and processes.
+"""
+
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+# Request priorities: lower numbers are more urgent:
+PRIORITY_HIGH   = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2
+
+
+class QuotaExceededError(RuntimeError):
+    """Raised when no API request can be made within the quota (in time)."""
+    pass
+
+
+class QuotaCancelledError(RuntimeError):
+    """Raised when waiting for the quota was cancelled."""
+    pass
+
+
+class QuotaManager:
+    """Manage the daily Meteoserver API request quota, shared between all threads and processes that use the
+    same database file.
+
+    Usage is stored in an SQLite database, so that it persists between runs and is shared between processes.
+    Requests are rate limited using a token bucket that refills at a constant rate up to a maximum burst size,
+    on top of the hard daily quota.  The daily count is reset at local midnight.
+
+    Requests have a priority (PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW, or any non-negative integer where
+    lower numbers are more urgent).  Waiting requests are served in order of priority, also across processes,
+    and a number of daily requests can be held back for more urgent requests.
+
+    Parameters:
+        dbFile (string):      The name of the SQLite database file to store the usage in.
+        dailyQuota (int):     The maximum number of API requests per day (default: 500).
+        rate (float):         The number of requests per second the bucket is refilled with (default: spread the
+                              daily quota evenly over the day).
+        burst (int):          The maximum number of requests that can be made in a burst, i.e. the size of the
+                              bucket (default: 10).
+        reserve (int):        The number of daily requests held back for each more urgent priority level
+                              (default: 0).  E.g. with reserve=50, normal-priority requests leave the last 50
+                              requests of the day for high-priority requests, and low-priority requests leave
+                              the last 100.
+        staleAfter (float):   Time in seconds after which a waiting request of a process that stopped polling is
+                              ignored (default: 10).
+
+    Example:
+        quota = QuotaManager('meteoserver_quota.sqlite', dailyQuota=500, burst=5)
+        data  = quota.call(read_json_url_weatherforecast, myKey, myLocation, priority=PRIORITY_HIGH)
+        print(quota.remaining())
+    """
+
+    def __init__(self, dbFile, dailyQuota=500, rate=None, burst=10, reserve=0, staleAfter=10):
+        self.dbFile     = dbFile
+        self.dailyQuota = int(dailyQuota)
+        self.rate       = float(rate) if(rate is not None) else self.dailyQuota/86400
+        self.burst      = float(burst)
+        self.reserve    = int(reserve)
+        self.staleAfter = float(staleAfter)
+
+        if(self.rate <= 0):
+            raise ValueError('QuotaManager(): the refill rate must be positive')
+
+        self._local = threading.local()  # One database connection per thread (and process)
+
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS bucket (id INTEGER PRIMARY KEY CHECK (id = 1), '
+                       'tokens REAL NOT NULL, updated REAL NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, priority INTEGER NOT NULL, '
+                       'seen REAL NOT NULL)')
+            db.execute('INSERT OR IGNORE INTO bucket VALUES (1, ?, ?, ?, 0)', (self.burst, time.time(), _today()))
+
+
+    def acquire(self, priority=PRIORITY_NORMAL, block=True, timeout=None, cancel=None):
+        """Take one request from the quota, if available.
+
+        Parameters:
+            priority (int):   The priority of the request; lower numbers are more urgent (default: PRIORITY_NORMAL).
+            block (bool):     Wait until a request is available (default: True).
+            timeout (float):  Maximum time in seconds to wait if block=True (default: None - wait indefinitely,
+                              unless the daily quota for this priority is used up).
+            cancel (Event):   Stop waiting and return False as soon as this threading.Event is set (default: None).
+
+        Returns:
+            bool:  True if a request was taken from the quota, False otherwise.
+        """
+
+        waiterId = uuid.uuid4().hex
+        endTime  = None if(timeout is None) else time.monotonic() + timeout
+
+        try:
+            while True:
+                if(cancel is not None and cancel.is_set()):
+                    return False
+
+                granted, waitTime = self._try_acquire(waiterId, priority, block)
+                if(granted):
+                    return True
+                if(not block or waitTime is None):  # Not waiting, or the daily quota is used up
+                    return False
+
+                if(endTime is not None):
+                    if(time.monotonic() + waitTime > endTime):
+                        return False
+                sleepTime = min(max(waitTime, 0.01), self.staleAfter/4)  # Keep our waiter entry alive
+                if(cancel is None):
+                    time.sleep(sleepTime)
+                elif(cancel.wait(sleepTime)):
+                    return False
+        finally:
+            if(block):
+                with self._transaction() as db:
+                    db.execute('DELETE FROM waiters WHERE id = ?', (waiterId,))
+
+
+    def call(self, function, *args, priority=PRIORITY_NORMAL, timeout=None, cancel=None, **kwargs):
+        """Call a function that makes a Meteoserver API request, after taking a request from the quota.
+
+        Parameters:
+            function (function):  The function to call, e.g. read_json_url_weatherforecast.
+            *args:                Positional arguments to pass to the function.
+            priority (int):       The priority of the request (default: PRIORITY_NORMAL).
+            timeout (float):      Maximum time in seconds to wait for the quota (default: None - indefinitely).
+            cancel (Event):       Stop waiting for the quota when this threading.Event is set (default: None).
+            **kwargs:             Keyword arguments to pass to the function.
+
+        Returns:
+            (any):  The return value of the function.
+
+        Raises:
+            QuotaExceededError:   If no request could be taken from the quota (in time).
+            QuotaCancelledError:  If waiting for the quota was cancelled.
+        """
+
+        if(not self.acquire(priority=priority, timeout=timeout, cancel=cancel)):
+            if(cancel is not None and cancel.is_set()):
+                raise QuotaCancelledError('QuotaManager.call(): waiting for the Meteoserver API quota was cancelled')
+            raise QuotaExceededError('QuotaManager.call(): the Meteoserver API quota is exhausted for priority '
+                                     + str(priority))
+        return function(*args, **kwargs)
+
+
+    def remaining(self, priority=PRIORITY_HIGH):
+        """Return the remaining quota, e.g. for a scheduler to plan its requests.
+
+        Parameters:
+            priority (int):  The priority to compute the available daily requests for (default: PRIORITY_HIGH,
+                             i.e. including all reserved requests).
+
+        Returns:
+            dict:  Dictionary containing:
+
+              - daily (int):        The number of requests left today for the given priority.
+              - used (int):         The number of requests made today.
+              - quota (int):        The daily quota.
+              - tokens (float):     The number of requests currently available in the token bucket.
+              - waitTime (float):   Time in seconds until the next request is available in the token bucket.
+              - resetTime (float):  Time in seconds until the daily count is reset (at local midnight).
+        """
+
+        with self._transaction() as db:
+            tokens, used = self._refill(db)
+
+        return {'daily':     max(self._daily_limit(priority) - used, 0),
+                'used':      used,
+                'quota':     self.dailyQuota,
+                'tokens':    tokens,
+                'waitTime':  max(1 - tokens, 0) / self.rate,
+                'resetTime': _seconds_to_midnight()}
+
+
+    def _try_acquire(self, waiterId, priority, register):
+        """Try to take one request from the quota in a single (exclusive) transaction.
+
+        Parameters:
+            waiterId (string):  Unique identifier of the request.
+            priority (int):     The priority of the request.
+            register (bool):    Register the request as waiting, so that less urgent requests give way.
+
+        Returns:
+            tuple (bool, float):  Tuple containing (granted, waitTime):
+
+              - granted (bool):    True if a request was taken from the quota.
+              - waitTime (float):  Estimated time in seconds before trying again makes sense, or None if the daily
+                                   quota for this priority is used up.
+        """
+
+        now = time.time()
+        with self._transaction() as db:
+            tokens, used = self._refill(db)
+
+            if(used >= self._daily_limit(priority)):
+                return False, None
+
+            # Give way to more urgent requests that are waiting (in any process):
+            db.execute('DELETE FROM waiters WHERE seen < ?', (now - self.staleAfter,))
+            urgent = db.execute('SELECT COUNT(*) FROM waiters WHERE priority < ? AND id != ?',
+                                (priority, waiterId)).fetchone()[0]
+
+            if(urgent == 0 and tokens >= 1):
+                db.execute('UPDATE bucket SET tokens = ?, used = ? WHERE id = 1', (tokens - 1, used + 1))
+                return True, 0
+
+            if(register):
+                db.execute('INSERT OR REPLACE INTO waiters VALUES (?, ?, ?)', (waiterId, priority, now))
+
+        return False, max(1 - tokens, 0) / self.rate
+
+
+    def _refill(self, db):
+        """Refill the token bucket for the time passed since the last update, and reset the daily count if a new
+        day has started.
+
+        Parameters:
+            db (sqlite3.Connection):  The database connection, in an exclusive transaction.
+
+        Returns:
+            tuple (float, int):  Tuple containing (tokens, used): the number of available tokens and the number
+            of requests made today.
+        """
+
+        tokens, updated, day, used = db.execute('SELECT tokens, updated, day, used FROM bucket WHERE id = 1').fetchone()
+
+        now   = time.time()
+        today = _today()
+        if(day != today):
+            used = 0
+
+        tokens = min(tokens + max(now - updated, 0) * self.rate, self.burst)
+        db.execute('UPDATE bucket SET tokens = ?, updated = ?, day = ?, used = ? WHERE id = 1',
+                   (tokens, now, today, used))
+
+        return tokens, used
+
+
+    def _daily_limit(self, priority):
+        """Return the number of daily requests available to requests with the given priority."""
+        return self.dailyQuota - self.reserve * max(int(priority), 0)
+
+
+    def _transaction(self):
+        """Return the database connection of the current thread as a context manager for an exclusive
+        transaction."""
+
+        db = getattr(self._local, 'db', None)
+        if(db is None or self._local.pid != os.getpid()):  # Do not share connections with forked processes
+            db = sqlite3.connect(self.dbFile, timeout=60, isolation_level=None)
+            self._local.db  = db
+            self._local.pid = os.getpid()
+
+        return _Transaction(db)
+
+
+class _Transaction:
+    """Context manager for an exclusive (BEGIN IMMEDIATE) SQLite transaction, which serialises all updates of
+    the quota between processes."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, excType, excValue, traceback):
+        if(excType is None):
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
+        return False
+
+
+def _today():
+    """Return the current local date as a string, used to reset the daily count."""
+    return time.strftime('%Y-%m-%d')
+
+
+def _seconds_to_midnight():
+    """Return the number of seconds until local midnight."""
+    now = time.localtime()
+    midnight = time.mktime((now.tm_year, now.tm_mon, now.tm_mday+1, 0, 0, 0, 0, 0, -1))
+    return max(midnight - time.time(), 0)
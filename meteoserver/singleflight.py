@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#  Copyright (c) 2020-2021  Marc van der Sluys - marc.vandersluys.nl
+#
+#  This file is part of the Meteoserver Python package, containing a Python module to obtain and read Dutch
+#  weather data from Meteoserver.nl.  See: https://github.com/MarcvdSluys/Meteoserver
+#
+#  This is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+#  This software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with this code.  If not, see
+#  <http://www.gnu.org/licenses/>.
+
+
+"""
+   Functions to obtain weather-forecast and Sun data from Meteoserver.nl while sharing a single download
+   between concurrent callers (threads or asyncio tasks) that ask for the same data at the same time.
+"""
+
+
+import asyncio
+import threading
+
+from .weatherforecast import read_json_url_weatherforecast
+from .sundata import read_json_url_sunData
+from .quota import PRIORITY_NORMAL
+
+
+class _Flight:
+    """A single in-flight download, shared by all callers that request the same data."""
+
+    def __init__(self):
+        self.done   = threading.Event()
+        self.result = None
+        self.error  = None
+
+
+_flights      = {}                # Dictionary of in-flight downloads: {key: _Flight}
+_flightsLock  = threading.Lock()  # Protects _flights
+_asyncFlights = {}                # Dictionary of in-flight downloads per event loop: {(loop, key): Future}
+
+
+def _single_flight(flightKey, fetch):
+    """Call fetch() once for all concurrent callers with the same key, and return its result to each of them.
+
+    The first caller (the leader) performs the download; callers that arrive while it is in flight wait for it
+    and receive the same result.  The flight is forgotten as soon as it is done, so that a later call will
+    download fresh data.
+
+    Parameters:
+        flightKey (tuple):    Hashable key identifying the data to download.
+        fetch (function):     Function without arguments that downloads and parses the data.
+
+    Returns:
+        (any):  The (shared) return value of fetch().  Callers must not modify it, but copy it instead.
+    """
+
+    with _flightsLock:
+        flight = _flights.get(flightKey)
+        leader = flight is None
+        if(leader):
+            flight = _Flight()
+            _flights[flightKey] = flight
+
+    if(leader):
+        try:
+            flight.result = fetch()
+        except BaseException as e:  # Pass any error on to the waiting callers as well
+            flight.error = e
+        finally:
+            with _flightsLock:
+                del _flights[flightKey]
+            flight.done.set()
+    else:
+        flight.done.wait()
+
+    if(flight.error is not None):
+        raise flight.error
+
+    return flight.result
+
+
+async def _single_flight_async(flightKey, fetch):
+    """Await a single call of fetch() for all concurrent asyncio tasks with the same key, and return its result.
+
+    The first task starts fetch() in the default executor of the running event loop, so that the loop is not
+    blocked; the other tasks await the same future.  Since the executor call goes through _single_flight(), the
+    download is shared with any threads that ask for the same data as well.
+
+    Parameters:
+        flightKey (tuple):    Hashable key identifying the data to download.
+        fetch (function):     Function without arguments that downloads and parses the data.
+
+    Returns:
+        (any):  The (shared) return value of fetch().  Callers must not modify it, but copy it instead.
+    """
+
+    eventLoop = asyncio.get_running_loop()
+    loopKey   = (eventLoop, flightKey)
+
+    future = _asyncFlights.get(loopKey)
+    if(future is None):
+        future = eventLoop.run_in_executor(None, _single_flight, flightKey, fetch)
+        _asyncFlights[loopKey] = future
+        future.add_done_callback(lambda _: _asyncFlights.pop(loopKey, None))
+
+    return await asyncio.shield(future)  # Shield: a cancelled task should not cancel the others' download
+
+
+def _fetch_weatherforecast(key, location, model, full, numeric, quota, priority, cancel=None):
+    """Return the shared flight key and download function for read_json_url_weatherforecast()."""
+
+    # Check the model here, since read_json_url_weatherforecast() would call exit(), which would be passed on to
+    # all waiting callers:
+    if(model not in ['HARMONIE', 'GFS']):
+        raise ValueError('read_json_url_weatherforecast_shared(): unknown model: '+str(model)
+                         +'; please choose between HARMONIE and GFS')
+
+    flightKey = ('weatherforecast', key, location, model, full, numeric)
+    return flightKey, lambda: _call(quota, priority, cancel, read_json_url_weatherforecast, key, location,
+                                    model=model, full=full, loc=True, numeric=numeric)
+
+
+def _fetch_sunData(key, location, numeric, quota, priority, cancel=None):
+    """Return the shared flight key and download function for read_json_url_sunData()."""
+
+    flightKey = ('sunData', key, location, numeric)
+    return flightKey, lambda: _call(quota, priority, cancel, read_json_url_sunData, key, location, loc=True,
+                                    numeric=numeric)
+
+
+def _call(quota, priority, cancel, function, *args, **kwargs):
+    """Call a download function, taking a request from the quota first if a QuotaManager is given."""
+
+    if(quota is None):
+        return function(*args, **kwargs)
+    return quota.call(function, *args, priority=priority, cancel=cancel, **kwargs)
+
+
+def read_json_url_weatherforecast_shared(key, location, model='GFS', full=False, loc=False, numeric=True,
+                                         quota=None, priority=PRIORITY_NORMAL, cancel=None):
+    """Get hourly weather-forecast data from the Meteoserver server, sharing the download between concurrent
+    callers, and return them as a dataframe.
+
+    This is a drop-in replacement for read_json_url_weatherforecast() for multi-threaded programs.  When several
+    threads ask for the same data (same key, location, model, full and numeric) at the same time, only one HTTP
+    request is made and the JSON data are parsed only once.  Each caller receives its own copy of the dataframe.
+
+    Parameters:
+        key (string):       The Meteoserver API key.
+        location (string):  The name of the location (in the Netherlands) to obtain data for (e.g. 'De Bilt').
+        model (string):     Weather model to use: 'HARMONIE' or 'GFS' (default: GFS).
+        full (bool):        Return the full dataframe (default: False).
+        loc (bool):         Return the location name as a second return value (default=False).
+        numeric (bool):     Convert dataframe content from strings to numeric/datetime format (default=True).
+        quota (QuotaManager):  Take the (single) request from this API quota, if given (default: None).
+        priority (int):     The priority of the request for the quota (default: PRIORITY_NORMAL).
+        cancel (Event):     Stop waiting for the quota when this threading.Event is set, and raise a
+                            QuotaCancelledError (default: None).  The event of the caller that starts the download
+                            applies to all callers sharing it.
+
+    Returns:
+        tuple (df, str):  Tuple containing (data, retLoc):
+
+          - data (df):     Pandas dataframe containing forecast data for the specified location (or region).
+          - retLoc (str):  The name of the location the data are for (only returned if loc=True - in this case,
+            the two return values are returned as a tuple).
+
+    Raises:
+        ValueError:  If the model is unknown.
+
+    See read_json_url_weatherforecast() for more details.
+    """
+
+    data, retLoc = _single_flight(*_fetch_weatherforecast(key, location, model, full, numeric, quota, priority,
+                                                          cancel))
+    data = data.copy()  # Each caller gets its own copy
+
+    if(loc):
+        return data, retLoc
+    else:
+        return data
+
+
+def read_json_url_sunData_shared(key, location, loc=False, numeric=True, quota=None, priority=PRIORITY_NORMAL,
+                                 cancel=None):
+    """Get the Sun data from the Meteoserver server, sharing the download between concurrent callers, and
+    return the current-data and forecast dataframes and optionally the location name.
+
+    This is a drop-in replacement for read_json_url_sunData() for multi-threaded programs.  When several threads
+    ask for the same data (same key, location and numeric) at the same time, only one HTTP request is made and
+    the JSON data are parsed only once.  Each caller receives its own copies of the dataframes.
+
+    Parameters:
+        key (string):       The Meteoserver API key.
+        location (string):  The name of the location (in the Netherlands) to obtain data for (e.g. 'De Bilt').
+        loc (bool):         Return the location name as a third return value (default=False).
+        numeric (bool):     Convert dataframe content from strings to numeric/datetime format (default=True).
+        quota (QuotaManager):  Take the (single) request from this API quota, if given (default: None).
+        priority (int):     The priority of the request for the quota (default: PRIORITY_NORMAL).
+        cancel (Event):     Stop waiting for the quota when this threading.Event is set, and raise a
+                            QuotaCancelledError (default: None).  The event of the caller that starts the download
+                            applies to all callers sharing it.
+
+    Returns:
+        tuple (df, df (,str)):  Tuple containing (current, forecast (, location)):
+
+          - current (df):   Pandas dataframe containing current-weather data from a nearby station.
+          - forecast (df):  Pandas dataframe containing forecast data for the specified location (or region?).
+          - retLoc (str):   The name of the location the data are for (only returned if loc=True).
+
+    See read_json_url_sunData() for more details.
+    """
+
+    current, forecast, retLoc = _single_flight(*_fetch_sunData(key, location, numeric, quota, priority, cancel))
+    current  = current.copy()  # Each caller gets its own copies
+    forecast = forecast.copy()
+
+    if(loc):
+        return current, forecast, retLoc
+    else:
+        return current, forecast
+
+
+async def read_json_url_weatherforecast_async(key, location, model='GFS', full=False, loc=False, numeric=True,
+                                               quota=None, priority=PRIORITY_NORMAL):
+    """Get hourly weather-forecast data from the Meteoserver server in an asyncio task, sharing the download
+    between concurrent callers, and return them as a dataframe.
+
+    The download is done in the default executor of the running event loop, so that the loop is not blocked.
+    Concurrent asyncio tasks and threads that ask for the same data share a single download.  The parameters
+    and return values are identical to those of read_json_url_weatherforecast_shared().
+    """
+
+    flightKey, fetch = _fetch_weatherforecast(key, location, model, full, numeric, quota, priority)
+    data, retLoc = await _single_flight_async(flightKey, fetch)
+    data = data.copy()  # Each caller gets its own copy
+
+    if(loc):
+        return data, retLoc
+    else:
+        return data
+
+
+async def read_json_url_sunData_async(key, location, loc=False, numeric=True, quota=None,
+                                      priority=PRIORITY_NORMAL):
+    """Get the Sun data from the Meteoserver server in an asyncio task, sharing the download between concurrent
+    callers, and return the current-data and forecast dataframes and optionally the location name.
+
+    The download is done in the default executor of the running event loop, so that the loop is not blocked.
+    Concurrent asyncio tasks and threads that ask for the same data share a single download.  The parameters
+    and return values are identical to those of read_json_url_sunData_shared().
+    """
+
+    flightKey, fetch = _fetch_sunData(key, location, numeric, quota, priority)
+    current, forecast, retLoc = await _single_flight_async(flightKey, fetch)
+    current  = current.copy()  # Each caller gets its own copies
+    forecast = forecast.copy()
+
+    if(loc):
+        return current, forecast, retLoc
+    else:
+        return current, forecast
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+#  Copyright (c) 2020-2021  Marc van der Sluys - marc.vandersluys.nl
+#
+#  This file is part of the Meteoserver Python package, containing a Python module to obtain and read Dutch
+#  weather data from Meteoserver.nl.  See: https://github.com/MarcvdSluys/Meteoserver
+#
+#  This is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+#  This software is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License along with this code.  If not, see
+#  <http://www.gnu.org/licenses/>.
+
+
+"""
+   An in-memory store holding the latest weather forecast per model and location as compact arrays, for fast
+   point and range queries, with an optional local HTTP front end.
+"""
+
+
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from .singleflight import read_json_url_weatherforecast_shared
+from .quota import PRIORITY_NORMAL
+
+
+class _Series:
+    """The forecast of one model run for one location, stored as read-only arrays.
+
+    Attributes:
+        times (array):    Sorted int64 array of UNIX timestamps ('tijd') of the forecast steps.
+        end (int):        UNIX timestamp of the end of the last forecast step.
+        values (array):   2D float32 array with one row per column and one value per forecast step.
+        columns (dict):   Dictionary {column name: row index in values}.
+        location (str):   The location name returned by the server.
+        run (int):        UNIX timestamp of the model run (or None if unknown).
+        ingested (float): UNIX timestamp of the moment the data were ingested.
+    """
+
+    __slots__ = ('times', 'end', 'values', 'columns', 'location', 'run', 'ingested')
+
+
+class ForecastStore:
+    """In-memory store holding the latest weather forecast for each (model, location), answering point and
+    range queries in microseconds.
+
+    Each forecast is stored as a sorted array of times and a single 2D float32 array containing all numeric
+    columns, rather than as a dataframe.  Queries are lock free: they read an immutable index that is replaced
+    as a whole whenever new data are ingested, so that readers always see either the old or the new run, for all
+    locations refreshed together.
+
+    Parameters:
+        columns (list):  Names of the columns to store (default: None - all numeric columns).
+
+    Example:
+        store = ForecastStore()
+        store.refresh(myKey, 'HARMONIE', ['De Bilt', 'Arnhem'])
+        temp  = store.point('HARMONIE', 'De Bilt', 'temp')                  # Now
+        times, values = store.next_hours('HARMONIE', 'Arnhem', 'temp', 6)  # Next 6 hours
+    """
+
+    def __init__(self, columns=None):
+        self.storeColumns = None if(columns is None) else list(columns)
+        self._index       = {}                # {(model, location): _Series}; never modified, only replaced
+        self._writeLock   = threading.Lock()  # Serialises writers; readers do not lock
+
+
+    def ingest(self, model, location, data, retLoc=None, run=None, replaceNewer=False):
+        """Store the forecast of a model for a location, replacing any earlier run.
+
+        If the stored forecast is from a newer model run than the new data (e.g. because the server returned a
+        lagging response), the stored forecast is kept, unless replaceNewer=True.
+
+        Parameters:
+            model (string):     The weather model the data are from (e.g. 'HARMONIE' or 'GFS').
+            location (string):  The location name to store the data under (the name used in queries).
+            data (df):          Pandas dataframe containing the forecast data, as returned by
+                                read_json_url_weatherforecast() with numeric=True.
+            retLoc (string):    The location name returned by the server (default: None).
+            run (int):          UNIX timestamp of the model run (default: None - derive it from the 'offset'
+                                column, if present).
+            replaceNewer (bool):  Replace the stored forecast even if it is from a newer model run (default: False).
+
+        Returns:
+            bool:  True if the data were stored, False if a newer run was kept.
+        """
+
+        return len(self.ingest_many({(model, location): (data, retLoc, run)}, replaceNewer=replaceNewer)) > 0
+
+
+    def ingest_many(self, forecasts, replaceNewer=False):
+        """Store the forecasts for several models and/or locations at once.
+
+        All forecasts become visible to queries at the same moment.  Stored forecasts from a newer model run are
+        kept, unless replaceNewer=True.
+
+        Parameters:
+            forecasts (dict):     Dictionary {(model, location): data} or {(model, location): (data, retLoc, run)},
+                                  see ingest().
+            replaceNewer (bool):  Replace stored forecasts even if they are from a newer model run (default: False).
+
+        Returns:
+            list:  List of the (model, location) pairs that were stored.
+        """
+
+        newSeries = {}
+        stored    = []
+        for storeKey, forecast in forecasts.items():
+            if(isinstance(forecast, pd.DataFrame)):
+                forecast = (forecast, None, None)
+            newSeries[storeKey] = self._build_series(*forecast)
+
+        with self._writeLock:
+            index = dict(self._index)
+            for storeKey, series in newSeries.items():
+                if(not replaceNewer and _is_older(series, index.get(storeKey))):
+                    continue  # Keep the newer run
+                index[storeKey] = series
+                stored.append(storeKey)
+            self._index = index  # Atomic replacement: readers see either the old or the new index
+
+        return stored
+
+
+    def refresh(self, key, model, locations, workers=8, quota=None, priority=PRIORITY_NORMAL):
+        """Download the latest forecasts of a model for one or more locations and ingest them atomically.
+
+        Stored forecasts from a newer model run than the downloaded ones are kept.
+
+        Parameters:
+            key (string):          The Meteoserver API key.
+            model (string):        Weather model to use: 'HARMONIE' or 'GFS'.
+            locations (list):      List of location names, or a single location name.
+            workers (int):         Maximum number of concurrent downloads (default: 8).
+            quota (QuotaManager):  Take the requests from this API quota, if given (default: None).
+            priority (int):        The priority of the requests for the quota (default: PRIORITY_NORMAL).
+
+        Returns:
+            list:  List of the (model, location) pairs that were updated.
+        """
+
+        if(isinstance(locations, str)):
+            locations = [locations]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {location: executor.submit(read_json_url_weatherforecast_shared, key, location, model=model,
+                                                 loc=True, quota=quota, priority=priority)
+                       for location in locations}
+            forecasts = {}
+            for location, future in futures.items():
+                data, retLoc = future.result()
+                forecasts[(model, location)] = (data, retLoc, None)
+
+        return self.ingest_many(forecasts)
+
+
+    def point(self, model, location, column, t=None):
+        """Return the forecast value of a column at a given time.
+
+        Parameters:
+            model (string):     The weather model.
+            location (string):  The location name.
+            column (string):    The name of the column (e.g. 'temp').
+            t (float):          UNIX timestamp (default: None - now).
+
+        Returns:
+            float:  The value for the forecast step containing time t, or NaN if t is outside the forecast.
+
+        Raises:
+            ValueError:  If t is not a finite number.
+        """
+
+        series = self._series(model, location)
+        row    = _row(series, column)
+        if(t is None):
+            t = time.time()
+        _check_finite(t=t)
+
+        idx = int(series.times.searchsorted(t, side='right')) - 1
+        if(idx < 0 or t >= series.end):
+            return float('nan')
+
+        return float(series.values[row, idx])
+
+
+    def range(self, model, location, columns, start, end):
+        """Return the forecast values of one or more columns for the steps overlapping a time range.
+
+        Parameters:
+            model (string):     The weather model.
+            location (string):  The location name.
+            columns (string/list):  The name of a column, or a list of column names.
+            start (float):      UNIX timestamp of the start of the range.
+            end (float):        UNIX timestamp of the end of the range (exclusive).
+
+        Returns:
+            tuple (array, array/dict):  Tuple containing (times, values):
+
+              - times (array):   Read-only array of the UNIX timestamps of the forecast steps.
+              - values (array/dict):  Read-only array with the values of the column, or a dictionary
+                {column: array} if a list of columns was given.
+        """
+
+        series = self._series(model, location)
+        _check_finite(start=start, end=end)
+
+        first = max(int(series.times.searchsorted(start, side='right')) - 1, 0)  # Include the step containing start
+        last  = int(series.times.searchsorted(end, side='left'))
+        if(start >= series.end):  # Beyond the end of the forecast
+            first = last
+        times = series.times[first:last]
+
+        if(isinstance(columns, str)):
+            return times, series.values[_row(series, columns), first:last]
+
+        return times, {column: series.values[_row(series, column), first:last] for column in columns}
+
+
+    def next_hours(self, model, location, columns, hours, now=None):
+        """Return the forecast values of one or more columns for the next hours.
+
+        Parameters:
+            model (string):     The weather model.
+            location (string):  The location name.
+            columns (string/list):  The name of a column, or a list of column names.
+            hours (float):      The number of hours to return, starting with the current forecast step.
+            now (float):        UNIX timestamp to use as the current time (default: None - now).
+
+        Returns:
+            tuple (array, array/dict):  Tuple containing (times, values); see range().
+        """
+
+        if(now is None):
+            now = time.time()
+        _check_finite(hours=hours, now=now)
+        return self.range(model, location, columns, now, now + hours*3600)
+
+
+    def keys(self):
+        """Return a list of the (model, location) pairs in the store."""
+        return list(self._index)
+
+
+    def info(self, model, location):
+        """Return a dictionary describing the stored forecast for a model and location.
+
+        The dictionary contains the location name returned by the server ('location'), the UNIX timestamps of
+        the model run ('run'), the first forecast step ('start'), the end of the forecast ('end') and the moment
+        the data were ingested ('ingested'), the number of forecast steps ('steps') and the list of columns
+        ('columns').
+        """
+
+        series = self._series(model, location)
+        return {'location': series.location, 'run': series.run, 'start': int(series.times[0]),
+                'end': series.end, 'ingested': series.ingested, 'steps': len(series.times),
+                'columns': list(series.columns)}
+
+
+    def _series(self, model, location):
+        """Return the stored series for a model and location, or raise a KeyError."""
+
+        try:
+            return self._index[(model, location)]
+        except KeyError:
+            raise KeyError('ForecastStore: no data for model '+str(model)+' and location '+str(location)) from None
+
+
+    def _build_series(self, data, retLoc, run):
+        """Convert a forecast dataframe to a _Series."""
+
+        if('tijd' not in data.columns or len(data) == 0):
+            raise ValueError('ForecastStore.ingest(): the forecast data must contain a non-empty tijd column')
+
+        # Convert the times first, so that rows without a valid time are dropped and strings are sorted as numbers:
+        tijd  = pd.to_numeric(data['tijd'], errors='coerce')
+        valid = np.isfinite(tijd.to_numpy(dtype=float))
+        data  = data.loc[valid].assign(tijd=tijd[valid]).sort_values('tijd', kind='stable')
+        data  = data.drop_duplicates('tijd')
+        if(len(data) == 0):
+            raise ValueError('ForecastStore.ingest(): the forecast data contain no valid tijd values')
+        times = data['tijd'].to_numpy(dtype=np.int64)
+
+        columns = self.storeColumns
+        if(columns is None):  # All numeric columns except time:
+            columns = [col for col in data.columns if(col != 'tijd' and pd.api.types.is_numeric_dtype(data[col])
+                                                      and not pd.api.types.is_bool_dtype(data[col]))]
+
+        values = np.empty((len(columns), len(times)), dtype=np.float32)
+        for row, col in enumerate(columns):
+            values[row] = pd.to_numeric(data[col], errors='coerce').to_numpy(dtype=np.float32)
+
+        if(run is None and 'offset' in data.columns):  # Model run = first step - hours since the run
+            offset = pd.to_numeric(data['offset'], errors='coerce').iloc[0]
+            if(not np.isnan(offset)):
+                run = int(times[0] - offset*3600)
+
+        times.flags.writeable  = False  # Query results are views of these arrays
+        values.flags.writeable = False
+
+        series = _Series()
+        series.times    = times
+        series.end      = int(times[-1] + (times[-1] - times[-2] if(len(times) > 1) else 3600))
+        series.values   = values
+        series.columns  = {col: row for row, col in enumerate(columns)}
+        series.location = retLoc
+        series.run      = run
+        series.ingested = time.time()
+        return series
+
+
+def _is_older(series, storedSeries):
+    """Return True if a series is from an older model run than the stored series (if both runs are known)."""
+
+    if(storedSeries is None or series.run is None or storedSeries.run is None):
+        return False
+    return series.run < storedSeries.run
+
+
+def _check_finite(**values):
+    """Raise a ValueError if one of the given (named) times is not a finite number."""
+
+    for name, value in values.items():
+        if(not math.isfinite(value)):
+            raise ValueError('ForecastStore: '+name+' must be a finite number, not '+str(value))
+
+
+def _row(series, column):
+    """Return the row of a column in the values array of a series, or raise a KeyError."""
+
+    try:
+        return series.columns[column]
+    except KeyError:
+        raise KeyError('ForecastStore: unknown column '+str(column)) from None
+
+
+def serve_store(store, host='127.0.0.1', port=8080, block=True):
+    """Serve queries on a ForecastStore over a lightweight local HTTP/JSON interface.
+
+    Endpoints (GET):
+      - /keys:                                                   list the (model, location) pairs in the store.
+      - /info?model=GFS&location=De Bilt:                        describe a stored forecast.
+      - /point?model=GFS&location=De Bilt&column=temp[&time=T]:  value at UNIX time T (default: now).
+      - /range?model=GFS&location=De Bilt&columns=temp,winds&start=T1&end=T2:  values in a time range.
+      - /range?model=GFS&location=De Bilt&columns=temp&hours=6:  values for the next 6 hours.
+
+    Values are returned with float32 precision, and missing values as null.  Unknown models, locations or columns
+    result in a 404 response, missing or invalid (including non-finite) parameters in a 400 response.
+
+    Parameters:
+        store (ForecastStore):  The store to serve.
+        host (string):  The host name or IP address to listen on (default: '127.0.0.1' - local only).
+        port (int):     The port to listen on (default: 8080).
+        block (bool):   Serve until interrupted (default: True).  If False, serve in a daemon thread and return
+                        immediately.
+
+    Returns:
+        ThreadingHTTPServer:  The server; call its shutdown() method to stop a non-blocking server.
+    """
+
+    class Handler(_StoreRequestHandler):
+        pass
+    Handler.store = store
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+
+    if(block):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    else:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+class _StoreRequestHandler(BaseHTTPRequestHandler):
+    """Handle HTTP GET requests for serve_store()."""
+
+    store = None
+
+    def do_GET(self):
+        url    = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+        try:
+            if(url.path == '/keys'):
+                result = [{'model': model, 'location': location} for model, location in self.store.keys()]
+            elif(url.path == '/info'):
+                result = self.store.info(params['model'], params['location'])
+            elif(url.path == '/point'):
+                t = _finite_param(params, 'time') if('time' in params) else None
+                value = self.store.point(params['model'], params['location'], params['column'], t)
+                result = {'time': t, 'value': _json_value(value)}
+            elif(url.path == '/range'):
+                columns = params['columns'].split(',')
+                if('hours' in params):
+                    times, values = self.store.next_hours(params['model'], params['location'], columns,
+                                                          _finite_param(params, 'hours'))
+                else:
+                    times, values = self.store.range(params['model'], params['location'], columns,
+                                                     _finite_param(params, 'start'), _finite_param(params, 'end'))
+                result = {'time': times.tolist()}
+                for column, columnValues in values.items():
+                    result[column] = [_json_value(value) for value in columnValues]
+            else:
+                self._send(404, {'error': 'unknown endpoint '+url.path})
+                return
+        except KeyError as e:
+            if(str(e.args[0]).startswith('ForecastStore:')):
+                self._send(404, {'error': str(e.args[0])})
+            else:
+                self._send(400, {'error': 'missing parameter '+str(e.args[0])})
+            return
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        self._send(200, result)
+
+    def _send(self, status, result):
+        body = json.dumps(result, allow_nan=False).encode()  # Never send the invalid JSON tokens NaN/Infinity
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # Do not log every request to stderr
+        pass
+
+
+def _finite_param(params, name):
+    """Return a query parameter as a finite float, or raise a KeyError (missing) or ValueError (invalid)."""
+
+    value = float(params[name])
+    if(not math.isfinite(value)):
+        raise ValueError('parameter '+name+' must be a finite number')
+    return value
+
+
+def _json_value(value):
+    """Convert a stored float32 value to the shortest float that represents it, or None if it is not finite."""
+
+    value = np.float32(value)
+    if(not np.isfinite(value)):
+        return None
+    return float(np.format_float_positional(value, unique=True, trim='-'))